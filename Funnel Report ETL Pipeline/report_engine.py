@@ -9,18 +9,35 @@ This file handles:
 
 Run the pipeline via run_reports.py; this module is imported there.
 """
+import functools
+import hashlib
+import json
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+
+try:
+    import orjson
+    _json_loads = orjson.loads  # several times faster than stdlib json on Drill responses
+except ImportError:
+    _json_loads = json.loads
 
 
 # =============================================================================
 # 1. SETTINGS — Load from environment (.env or os.environ)
 # =============================================================================
 
+@functools.lru_cache(maxsize=1)
 def load_config():
-    """Load Drill, output dir, and SMTP settings from env. Uses python-dotenv if available."""
+    """
+    Load Drill, output dir, and SMTP settings from env. Uses python-dotenv if available.
+    Cached: .env and the environment are read once per process; treat the returned dict as read-only.
+    """
     try:
         from dotenv import load_dotenv
         load_dotenv()
@@ -31,6 +48,7 @@ def load_config():
         "drill_port": int(os.environ.get("DRILL_PORT", "8047")),
         "drill_base_path": os.environ.get("DRILL_DATA_BASE", "/data/user-funnel"),
         "output_dir": os.environ.get("OUTPUT_DIR", "./output"),
+        "drill_cache_dir": os.environ.get("DRILL_CACHE_DIR", "./.drill_cache"),
         "smtp": {
             "from": os.environ.get("SMTP_FROM", ""),
             "host": os.environ.get("SMTP_HOST", "smtp.example.com"),
@@ -45,45 +63,111 @@ def load_config():
 # 2. DRILL QUERIES — Run SQL on Apache Drill, return DataFrames
 # =============================================================================
 
-def run_sql(sql, host, port):
-    """Execute one SQL statement via Drill REST API; return rows as a DataFrame (or empty on error)."""
+# One keep-alive session for all Drill queries. urllib3's connection pool is thread-safe and
+# sized for the entity and fetch thread pools, so sockets are reused instead of reopened per query.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+
+# Directory for cached Drill results; None disables the cache. Set via configure_cache().
+_CACHE_DIR = None
+
+
+def configure_cache(cache_dir):
+    """Enable the on-disk Drill result cache in cache_dir, or disable it with None."""
+    global _CACHE_DIR
+    _CACHE_DIR = cache_dir
+
+
+def _is_settled(date_spec):
+    """
+    True if the last day date_spec covers is before yesterday. Those daily files no longer change,
+    so their results can be cached without invalidation. No date_spec, or one that doesn't parse,
+    is never cached.
+    """
+    if not date_spec:
+        return False
+    last = date_spec.split("->")[-1].strip()
+    try:
+        if last.startswith("*"):
+            end = pd.to_datetime(last[1:], format="%m_%Y") + pd.offsets.MonthEnd(0)
+        else:
+            end = _parse_day(last)
+    except ValueError:
+        return False
+    return end < pd.Timestamp.now().normalize() - pd.Timedelta(days=1)
+
+
+def disk_cached(fn):
+    """
+    Cache fn(sql, host, port, date_spec) row lists as JSON under _CACHE_DIR, keyed by sha1 of
+    host, port, date_spec and SQL. Only queries whose date_spec is settled (see _is_settled) are cached.
+    """
+    @functools.wraps(fn)
+    def wrapper(sql, host, port, date_spec=None):
+        if _CACHE_DIR is None or not _is_settled(date_spec):
+            return fn(sql, host, port, date_spec)
+        key = hashlib.sha1(f"{host}:{port}\n{date_spec}\n{sql}".encode()).hexdigest()
+        path = os.path.join(_CACHE_DIR, f"{key}.json")
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                return json.load(f)
+        rows = fn(sql, host, port, date_spec)
+        if rows:  # empty may mean a failed request; don't pin it
+            os.makedirs(_CACHE_DIR, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(rows, f)
+            os.replace(tmp, path)
+        return rows
+    return wrapper
+
+
+@disk_cached
+def run_sql_rows(sql, host, port, date_spec=None):
+    """
+    Execute one SQL statement via Drill REST API; return the raw rows as a list of dicts (empty on error).
+    date_spec is the dates the SQL reads; it only decides whether the result may be cached.
+    """
     url = f"http://{host}:{port}/query.json"
     try:
-        r = requests.post(
+        r = _SESSION.post(
             url,
             headers={"Content-Type": "application/json"},
             json={"queryType": "SQL", "query": sql, "options": {"drill.exec.http.rest.errors.verbose": "true"}},
         )
         r.raise_for_status()
-        out = r.json()
-        return pd.DataFrame(out["rows"]) if "rows" in out else pd.DataFrame()
-    except requests.exceptions.RequestException as e:
-        print(f"Drill request failed: {e}")
-        return pd.DataFrame()
+        out = _json_loads(r.content)
+        return out.get("rows", [])
+    except (requests.exceptions.RequestException, ValueError) as e:  # ValueError: malformed JSON body
+        logging.warning("Drill request failed: %s", e)  # runs on worker threads; logging is thread-safe
+        return []
+
+
+def run_sql(sql, host, port, date_spec=None):
+    """Execute one SQL statement via Drill REST API; return rows as a DataFrame (or empty on error)."""
+    return pd.DataFrame(run_sql_rows(sql, host, port, date_spec))
+
+
+def _parse_day(day_str):
+    """Parse a dd_mm_yyyy date string into a pandas Timestamp."""
+    return pd.to_datetime(day_str.strip(), format="%d_%m_%Y")
 
 
 def _date_range(start_str, end_str):
     """Return list of dates as dd_mm_yyyy between start and end (inclusive)."""
-    start = datetime.strptime(start_str.strip(), "%d_%m_%Y")
-    end = datetime.strptime(end_str.strip(), "%d_%m_%Y")
-    out = []
-    cur = start
-    while cur <= end:
-        out.append(cur.strftime("%d_%m_%Y"))
-        cur += timedelta(days=1)
-    return out
+    return pd.date_range(_parse_day(start_str), _parse_day(end_str), freq="D").strftime("%d_%m_%Y").tolist()
 
 
 def _month_prefixes(start_str, end_str):
     """Return list of month specs (*mm_yyyy) that cover the given date range (for stage CSV paths)."""
-    start = datetime.strptime(start_str.strip(), "%d_%m_%Y")
-    end = datetime.strptime(end_str.strip(), "%d_%m_%Y")
-    out = []
-    cur = start.replace(day=1)
-    while cur <= end:
-        out.append(f"*{cur.strftime('%m_%Y')}")
-        cur = (cur + timedelta(days=32)).replace(day=1)
-    return out
+    start = _parse_day(start_str).replace(day=1)
+    return pd.date_range(start, _parse_day(end_str), freq="MS").strftime("*%m_%Y").tolist()
+
+
+def _date_glob(start_str, end_str):
+    """Return a Drill dfs brace glob ({d1,d2,...}) matching every day directory in the range."""
+    return "{" + ",".join(_date_range(start_str, end_str)) + "}"
 
 
 def fetch_stage_metrics(base_path, entity_id, date_spec, host, port):
@@ -94,109 +178,128 @@ def fetch_stage_metrics(base_path, entity_id, date_spec, host, port):
     if "->" in date_spec:
         parts = [p.strip() for p in date_spec.split("->")]
         prefixes = _month_prefixes(parts[0], parts[1])
-        frames = []
+        # Collect raw rows from every month and build one DataFrame, instead of one per month + concat.
+        rows = []
         for p in prefixes:
             sql = f"SELECT * FROM dfs.`{base_path}/{p}/uf-stages-user-funnel-{p}.csv` WHERE Entity_ID = '{entity_id}'"
-            frames.append(run_sql(sql, host, port))
-        if not frames:
+            rows.extend(run_sql_rows(sql, host, port, p))
+        if not rows:
             return pd.DataFrame()
-        combined = pd.concat(frames)
+        combined = pd.DataFrame(rows)
         combined["Date"] = pd.to_datetime(combined["Date"], format="%d-%m-%Y")
-        start = datetime.strptime(parts[0], "%d_%m_%Y")
-        end = datetime.strptime(parts[1], "%d_%m_%Y")
+        start = _parse_day(parts[0])
+        end = _parse_day(parts[1])
         return combined[(combined["Date"] >= start) & (combined["Date"] <= end)].reset_index(drop=True)
     if date_spec.startswith("*"):
         sql = f"SELECT * FROM dfs.`{base_path}/{date_spec}/uf-stages-user-funnel-{date_spec}.csv` WHERE Entity_ID = '{entity_id}'"
     else:
         sql = f"SELECT * FROM dfs.`{base_path}/{date_spec}/uf-stages-user-funnel-{date_spec}.csv` WHERE Entity_ID = '{entity_id}'"
-    return run_sql(sql, host, port)
+    return run_sql(sql, host, port, date_spec)
 
 
-def fetch_otp_totals(base_path, entity_id, date_spec, host, port):
-    """OTP breakdown: correct / incorrect / not entered. Same date_spec formats as fetch_stage_metrics. One row returned."""
+def fetch_stage_totals(base_path, entity_id, date_spec, host, port):
+    """
+    Stage totals summed by Drill: one row with one column per STAGE_COLUMNS entry, or an empty
+    DataFrame if the entity has no stage rows. Same date_spec formats as fetch_stage_metrics.
+    """
+    sums = ",\n           ".join(f"COALESCE(SUM(CAST({c} AS DOUBLE)), 0) AS {c}" for c in STAGE_COLUMNS)
+    where = f"Entity_ID = '{entity_id}'"
     if "->" in date_spec:
+        # Same months fetch_stage_metrics reads, in one glob; the Date filter trims them to the range.
         parts = [p.strip() for p in date_spec.split("->")]
-        dates = _date_range(parts[0], parts[1])
-        frames = []
-        for d in dates:
-            sql = f"""
-            SELECT SUM(CAST(Correct_OTP_Entered AS DOUBLE)) AS Total_Correct_OTP_Entered,
-                   SUM(CAST(Incorrect_OTP_Entered AS DOUBLE)) AS Total_Incorrect_OTP_Entered,
-                   SUM(CAST(OTP_Not_Entered AS DOUBLE)) AS Total_OTP_Not_Entered
-            FROM dfs.`{base_path}/{d}/otp-summary-user-funnel-{d}.csv` WHERE entity_id = '{entity_id}'
-            """
-            frames.append(run_sql(sql, host, port))
-        if not frames:
-            return pd.DataFrame()
-        return pd.concat(frames).sum(numeric_only=True).to_frame().T.reset_index(drop=True)
+        start, end = _parse_day(parts[0]), _parse_day(parts[1])
+        path = "{" + ",".join(_month_prefixes(parts[0], parts[1])) + "}/uf-stages-user-funnel-*.csv"
+        where += (
+            f" AND TO_DATE(`Date`, 'dd-MM-yyyy') BETWEEN DATE '{start:%Y-%m-%d}' AND DATE '{end:%Y-%m-%d}'"
+        )
+    else:
+        path = f"{date_spec}/uf-stages-user-funnel-{date_spec}.csv"
     sql = f"""
-    SELECT SUM(CAST(Correct_OTP_Entered AS DOUBLE)) AS Total_Correct_OTP_Entered,
-           SUM(CAST(Incorrect_OTP_Entered AS DOUBLE)) AS Total_Incorrect_OTP_Entered,
-           SUM(CAST(OTP_Not_Entered AS DOUBLE)) AS Total_OTP_Not_Entered
-    FROM dfs.`{base_path}/{date_spec}/otp-summary-user-funnel-{date_spec}.csv` WHERE entity_id = '{entity_id}'
+    SELECT COUNT(*) AS row_count,
+           {sums}
+    FROM dfs.`{base_path}/{path}` WHERE {where}
     """
-    return run_sql(sql, host, port)
+    df = run_sql(sql, host, port, date_spec)
+    # SUM over zero rows still yields one row, so use the row count to report "no data".
+    if df.empty or not int(float(df["row_count"].iloc[0])):
+        return pd.DataFrame()
+    return df.drop(columns="row_count")
 
 
-def fetch_discovery_totals(base_path, entity_id, date_spec, host, port):
-    """Discovery breakdown (Account_Discovered, Account_not_Found, etc.). One row returned."""
+# SQL templates for the summary fetchers; {path} is relative to {base} (see _csv_path).
+_OTP_SQL = """
+SELECT SUM(CAST(Correct_OTP_Entered AS DOUBLE)) AS Total_Correct_OTP_Entered,
+       SUM(CAST(Incorrect_OTP_Entered AS DOUBLE)) AS Total_Incorrect_OTP_Entered,
+       SUM(CAST(OTP_Not_Entered AS DOUBLE)) AS Total_OTP_Not_Entered
+FROM dfs.`{base}/{path}` WHERE entity_id = '{eid}'
+"""
+
+_DISCOVERY_SQL = """
+SELECT SUM(CAST(NULLIF(Account_Discovered,'') AS DOUBLE)) AS Account_Discovered,
+       SUM(CAST(NULLIF(Account_not_Found,'') AS DOUBLE)) AS Account_not_Found,
+       SUM(CAST(NULLIF(FIP_Not_Selected,'') AS DOUBLE)) AS FIP_Not_Selected,
+       SUM(CAST(NULLIF(Failure,'') AS DOUBLE)) AS Failure,
+       SUM(CAST(NULLIF(NO_STATUS,'') AS DOUBLE)) AS NO_STATUS
+FROM dfs.`{base}/{path}` WHERE entity_id = '{eid}'
+"""
+
+_FI_STATUS_SQL = """
+SELECT fetch_status, COUNT(fetch_status) AS Count
+FROM dfs.`{base}/{path}`
+WHERE entity_id = '{eid}' AND fetch_status IN ('Not Attempted','Failed','Success')
+  AND fetch_status IS NOT NULL AND fetch_status <> ''
+GROUP BY fetch_status
+"""
+
+
+def _csv_path(date_spec, prefix):
+    """
+    Path of the {prefix}-{date}.csv file(s) for date_spec, relative to the Drill base path.
+    A range becomes one brace glob over its day directories, so Drill aggregates it in one query.
+    """
     if "->" in date_spec:
         parts = [p.strip() for p in date_spec.split("->")]
-        dates = _date_range(parts[0], parts[1])
-        frames = []
-        for d in dates:
-            sql = f"""
-            SELECT SUM(CAST(NULLIF(Account_Discovered,'') AS DOUBLE)) AS Account_Discovered,
-                   SUM(CAST(NULLIF(Account_not_Found,'') AS DOUBLE)) AS Account_not_Found,
-                   SUM(CAST(NULLIF(FIP_Not_Selected,'') AS DOUBLE)) AS FIP_Not_Selected,
-                   SUM(CAST(NULLIF(Failure,'') AS DOUBLE)) AS Failure,
-                   SUM(CAST(NULLIF(NO_STATUS,'') AS DOUBLE)) AS NO_STATUS
-            FROM dfs.`{base_path}/{d}/discovery-summary-user-funnel-{d}.csv` WHERE entity_id = '{entity_id}'
-            """
-            frames.append(run_sql(sql, host, port))
-        if not frames:
-            return pd.DataFrame()
-        return pd.concat(frames).sum(numeric_only=True).to_frame().T.reset_index(drop=True)
-    sql = f"""
-    SELECT SUM(CAST(NULLIF(Account_Discovered,'') AS DOUBLE)) AS Account_Discovered,
-           SUM(CAST(NULLIF(Account_not_Found,'') AS DOUBLE)) AS Account_not_Found,
-           SUM(CAST(NULLIF(FIP_Not_Selected,'') AS DOUBLE)) AS FIP_Not_Selected,
-           SUM(CAST(NULLIF(Failure,'') AS DOUBLE)) AS Failure,
-           SUM(CAST(NULLIF(NO_STATUS,'') AS DOUBLE)) AS NO_STATUS
-    FROM dfs.`{base_path}/{date_spec}/discovery-summary-user-funnel-{date_spec}.csv` WHERE entity_id = '{entity_id}'
-    """
-    return run_sql(sql, host, port)
+        return f"{_date_glob(parts[0], parts[1])}/{prefix}-*.csv"
+    return f"{date_spec}/{prefix}-{date_spec}.csv"
+
+
+def fetch_otp_totals(base_path, entity_id, date_spec, host, port):
+    """OTP breakdown: correct / incorrect / not entered. Same date_spec formats as fetch_stage_metrics. One row returned."""
+    path = _csv_path(date_spec, "otp-summary-user-funnel")
+    return run_sql(_OTP_SQL.format(base=base_path, path=path, eid=entity_id), host, port, date_spec)
+
+
+def fetch_discovery_totals(base_path, entity_id, date_spec, host, port):
+    """Discovery breakdown (Account_Discovered, Account_not_Found, etc.). One row returned."""
+    path = _csv_path(date_spec, "discovery-summary-user-funnel")
+    return run_sql(_DISCOVERY_SQL.format(base=base_path, path=path, eid=entity_id), host, port, date_spec)
 
 
 def fetch_fi_status_counts(base_path, entity_id, date_spec, host, port):
     """FI fetch status counts (Not Attempted, Failed, Success). Returns DataFrame with fetch_status and Count columns."""
-    if "->" in date_spec:
-        parts = [p.strip() for p in date_spec.split("->")]
-        dates = _date_range(parts[0], parts[1])
-        frames = []
-        for d in dates:
-            sql = f"""
-            SELECT fetch_status, COUNT(fetch_status) AS Count
-            FROM dfs.`{base_path}/{d}/user-funnel-{d}.csv`
-            WHERE entity_id = '{entity_id}' AND fetch_status IN ('Not Attempted','Failed','Success')
-              AND fetch_status IS NOT NULL AND fetch_status <> ''
-            GROUP BY fetch_status
-            """
-            frames.append(run_sql(sql, host, port))
-        if not frames:
-            return pd.DataFrame()
-        combined = pd.concat(frames)
-        if combined.empty:
-            return combined
-        return combined.groupby("fetch_status")["Count"].sum().reset_index()
-    sql = f"""
-    SELECT fetch_status, COUNT(fetch_status) AS Count
-    FROM dfs.`{base_path}/{date_spec}/user-funnel-{date_spec}.csv`
-    WHERE entity_id = '{entity_id}' AND fetch_status IN ('Not Attempted','Failed','Success')
-      AND fetch_status IS NOT NULL AND fetch_status <> ''
-    GROUP BY fetch_status
+    path = _csv_path(date_spec, "user-funnel")
+    return run_sql(_FI_STATUS_SQL.format(base=base_path, path=path, eid=entity_id), host, port, date_spec)
+
+
+# Shared pool for fetch_all, so concurrent entities don't each spin up their own threads.
+_FETCH_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="drill-fetch")
+
+
+def fetch_all(base_path, entity_id, date_spec, host, port):
+    """
+    Run the four fetch_* queries for one entity concurrently (they are independent).
+    Returns (stage_df, otp_df, discovery_df, fi_status_df). If the stage totals come back empty
+    (no data for the entity), the other three are cancelled if still queued and returned empty;
+    any that already started still cost a Drill query.
     """
-    return run_sql(sql, host, port)
+    fetchers = (fetch_stage_totals, fetch_otp_totals, fetch_discovery_totals, fetch_fi_status_counts)
+    futures = [_FETCH_POOL.submit(fn, base_path, entity_id, date_spec, host, port) for fn in fetchers]
+    stage_df = futures[0].result()
+    if stage_df.empty:
+        for f in futures[1:]:
+            f.cancel()
+        return stage_df, pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    return (stage_df,) + tuple(f.result() for f in futures[1:])
 
 
 # =============================================================================
@@ -220,9 +323,28 @@ STAGE_COLUMNS = [
 
 
 def aggregate_stages(stage_df):
-    """Sum the stage columns across all rows (e.g. across dates); return a single Series (one value per column)."""
-    subset = stage_df[STAGE_COLUMNS]
-    return subset.astype(float).astype(int).sum()
+    """
+    Sum the stage columns across all rows (e.g. across dates); return a single Series (one value per column).
+    For the one-row output of fetch_stage_totals this just unwraps the row.
+    Raises ValueError if any stage cell is missing (NaN), rather than reporting a bogus count.
+    """
+    # Drill returns numeric strings; one float64 array and a numpy column sum, no intermediate DataFrames.
+    arr = stage_df[STAGE_COLUMNS].to_numpy(dtype=np.float64)
+    totals = arr.sum(axis=0)
+    if not np.isfinite(totals).all():
+        bad = [c for c, ok in zip(STAGE_COLUMNS, np.isfinite(totals)) if not ok]
+        raise ValueError(f"Cannot convert non-finite stage totals to int: {', '.join(bad)}")
+    return pd.Series(totals.astype(np.int64), index=STAGE_COLUMNS)
+
+
+# Discovery breakdown columns (discovery-summary CSV), in report order.
+DISCOVERY_COLUMNS = ["Account_Discovered", "Account_not_Found", "FIP_Not_Selected", "Failure", "NO_STATUS"]
+
+
+def _first_row_counts(df, columns):
+    """First row of df's columns as an int64 array in one numpy pass; missing columns and NaN count as 0."""
+    vals = df.reindex(columns=columns).iloc[:1].to_numpy(dtype=np.float64).ravel()
+    return np.nan_to_num(vals, nan=0.0).astype(np.int64)
 
 
 def _pct(value, total):
@@ -255,10 +377,9 @@ def build_report_table(stage_totals, otp_totals, discovery_totals, fi_status_df)
     disc = {}
     d3 = 0
     if not discovery_totals.empty:
-        for col in ["Account_Discovered", "Account_not_Found", "FIP_Not_Selected", "Failure", "NO_STATUS"]:
-            v = discovery_totals[col].iloc[0]
-            disc[col] = int(float(v)) if pd.notna(v) else 0
-        d3 = sum(disc.values())
+        vals = _first_row_counts(discovery_totals, DISCOVERY_COLUMNS)
+        disc = dict(zip(DISCOVERY_COLUMNS, vals.tolist()))
+        d3 = int(vals.sum())
 
     d4 = int(stage_totals["Linking"])
     rej = int(stage_totals["Rejected_Consent_Requests"])
@@ -281,8 +402,9 @@ def build_report_table(stage_totals, otp_totals, discovery_totals, fi_status_df)
         fi_req_ok = int(s) + int(f)
     fi_fetch_drop = fi_req_ok - fetch_ok
 
-    otp_wrong = int(otp_totals["Total_Incorrect_OTP_Entered"].iloc[0]) if not otp_totals.empty else 0
-    otp_miss = int(otp_totals["Total_OTP_Not_Entered"].iloc[0]) if not otp_totals.empty else 0
+    otp_wrong, otp_miss = 0, 0
+    if not otp_totals.empty:
+        otp_wrong, otp_miss = _first_row_counts(otp_totals, ["Total_Incorrect_OTP_Entered", "Total_OTP_Not_Entered"]).tolist()
     otp_ok_drop = d2 - (otp_wrong + otp_miss) + view_drop
 
     no_rec = disc.get("Account_not_Found", 0)
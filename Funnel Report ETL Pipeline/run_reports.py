@@ -18,25 +18,28 @@ This file handles:
 Usage: python run_reports.py
   Uses yesterday (t-1) by default. Configure via .env (see .env.example).
 """
+import base64
+import functools
 import json
+import mmap
 import os
 import logging
 import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
 
+import numpy as np
 import pandas as pd
 
 # Import data and funnel logic from the other module
 from report_engine import (
     load_config,
-    fetch_stage_metrics,
-    fetch_otp_totals,
-    fetch_discovery_totals,
-    fetch_fi_status_counts,
+    configure_cache,
+    fetch_all,
     aggregate_stages,
     build_report_table,
     get_mock_funnel_data,
@@ -49,6 +52,13 @@ from report_engine import (
 
 def load_recipients(path="recipients.json"):
     """Read recipients.json; return to_map (entity → list of To emails), cc_map (entity → CC list), and default_cc."""
+    # Keyed on mtime too, so an edited file is re-read while repeat calls skip the disk read and parse.
+    return _load_recipients_cached(path, os.path.getmtime(path))
+
+
+@functools.lru_cache(maxsize=4)
+def _load_recipients_cached(path, mtime):
+    """Parse recipients.json for load_recipients; mtime is only part of the cache key."""
     with open(path, "r") as f:
         data = json.load(f)
     to_map = data.get("to", {})
@@ -63,12 +73,14 @@ def load_recipients(path="recipients.json"):
 
 def write_funnel_excel(table_df, filepath):
     """Write the funnel report DataFrame to an Excel file with colors and column layout (gray headers, green success, brown dropoff)."""
-    blank = pd.DataFrame({i: [""] for i in range(table_df.shape[1])})
-    out = pd.concat([blank, table_df], ignore_index=True)
+    # Sheet row 0 is left blank, so table row i lands on sheet row i + 1 (vals[r - 1] for sheet row r).
+    # NaN -> None once for the whole table (xlsxwriter writes None as a formatted blank), so no per-cell checks.
+    vals = table_df.to_numpy(dtype=object)
+    vals[pd.isna(vals)] = None
 
+    # Every non-empty cell is written below with its format, so skip to_excel's unformatted first pass.
     with pd.ExcelWriter(filepath, engine="xlsxwriter") as wb:
-        out.to_excel(wb, sheet_name="Funnel Dashboard", index=False, header=False)
-        sheet = wb.sheets["Funnel Dashboard"]
+        sheet = wb.book.add_worksheet("Funnel Dashboard")
 
         sheet.set_column(0, 0, 45)
         sheet.set_column(1, 1, 45)
@@ -85,52 +97,113 @@ def write_funnel_excel(table_df, filepath):
         border = wb.book.add_format({"border": 1, "align": "left", "valign": "vcenter"})
         note_g = wb.book.add_format({"align": "left", "valign": "vcenter", "text_wrap": True, "bg_color": "#d9d9d9", "border": 1})
         note_w = wb.book.add_format({"align": "left", "valign": "vcenter", "text_wrap": True, "border": 1})
+        stage_fmt = wb.book.add_format({"align": "left", "valign": "vcenter", "text_wrap": True, "border": 1, "bg_color": "#d9d9d9"})
 
-        sheet.merge_range(1, 3, 1, 4, out.iloc[1, 3], note_g)
-        sheet.merge_range(2, 3, 2, 4, out.iloc[2, 3], note_w)
-        sheet.merge_range(5, 2, 5, 3, out.iloc[5, 2], gray)
-        sheet.merge_range(5, 5, 5, 6, out.iloc[5, 5], gray)
+        # Summary (rows 1-3) and table headers (row 5), in row order.
+        sheet.write_row(1, 0, vals[0, :2].tolist(), gray)
+        sheet.merge_range(1, 3, 1, 4, vals[0, 3], note_g)
+        sheet.write_row(2, 0, vals[1, :2].tolist(), border)
+        sheet.merge_range(2, 3, 2, 4, vals[1, 3], note_w)
+        sheet.write_row(3, 0, vals[2, :2].tolist(), border)
+        sheet.merge_range(5, 2, 5, 3, vals[4, 2], gray)
+        sheet.merge_range(5, 5, 5, 6, vals[4, 5], gray)
 
         success_rows = {7, 8, 9, 13, 18, 19, 22, 23, 24}
         drop_main = {7, 8, 9, 13, 18, 19, 22, 23, 24}
         drop_sub = {10, 11, 12, 14, 15, 16, 17, 20, 21}
 
-        for r in range(6, 25):
-            for c in range(7):
-                fmt = border
-                if r == 6 or c == 0:
-                    fmt = gray
-                if c in (1, 2, 3) and r in success_rows:
-                    fmt = green
-                if c == 4:
-                    fmt = dark if r in drop_main else (light if r in drop_sub else border)
-                if c in (5, 6) and r in drop_main:
-                    fmt = dark
-                val = out.iloc[r, c]
-                if pd.isna(val):
-                    sheet.write_blank(r, c, None, fmt)
-                else:
-                    sheet.write(r, c, val, fmt)
-
-        sheet.write(1, 0, out.iloc[1, 0], gray)
-        sheet.write(1, 1, out.iloc[1, 1], gray)
-        for r in range(2, 4):
-            for c in range(2):
-                val = out.iloc[r, c]
-                (sheet.write_blank if pd.isna(val) else sheet.write)(r, c, val if not pd.isna(val) else None, border)
-
-        stage_fmt = wb.book.add_format({"align": "left", "valign": "vcenter", "text_wrap": True, "border": 1, "bg_color": "#d9d9d9"})
-        sheet.merge_range("A10:A13", out.iloc[9, 0], stage_fmt)
-        sheet.merge_range("A14:A18", out.iloc[13, 0], stage_fmt)
-        sheet.merge_range("A20:A22", out.iloc[19, 0], stage_fmt)
+        # Format for every cell of the stage table (rows 6-24), as indexes into palette; first match wins.
+        palette = [border, gray, green, dark, light]
+        r = np.arange(6, 25)[:, None]
+        c = np.arange(7)[None, :]
+        main, sub, ok = np.isin(r, list(drop_main)), np.isin(r, list(drop_sub)), np.isin(r, list(success_rows))
+        codes = np.select(
+            [(c == 4) & main, (c == 4) & sub, c == 4, np.isin(c, (5, 6)) & main, np.isin(c, (1, 2, 3)) & ok, (r == 6) | (c == 0)],
+            [3, 4, 0, 3, 2, 1],
+            default=0,
+        )
+        values = vals[5:24, :7]
+
+        # One write_row per row in the row's most common format, then rewrite only the odd cells.
+        for i, (row_vals, row_codes) in enumerate(zip(values.tolist(), codes.tolist())):
+            base = max(set(row_codes), key=row_codes.count)
+            sheet.write_row(i + 6, 0, row_vals, palette[base])
+            for col, code in enumerate(row_codes):
+                if code != base:
+                    sheet.write(i + 6, col, row_vals[col], palette[code])
+
+        # The vertical stage merges go last: they overwrite column A of rows already written above,
+        # so this sheet is not written in row order and cannot use xlsxwriter's constant_memory mode.
+        sheet.merge_range("A10:A13", vals[8, 0], stage_fmt)
+        sheet.merge_range("A14:A18", vals[12, 0], stage_fmt)
+        sheet.merge_range("A20:A22", vals[18, 0], stage_fmt)
+
+
+def write_report(table_df, filepath, fmt="xlsx"):
+    """Write the funnel table as the styled Excel dashboard (xlsx) or as a plain, unstyled CSV (csv)."""
+    if fmt == "csv":
+        table_df.to_csv(filepath, index=False, header=False)
+    else:
+        write_funnel_excel(table_df, filepath)
 
 
 # =============================================================================
 # 3. EMAIL — Send report via SMTP
 # =============================================================================
 
-def send_report_mail(to_addrs, subject, body_html, attachments=None, cc_addrs=None, smtp_config=None):
-    """Send an email with HTML body and optional file attachments. smtp_config: from, host, port, user, password. Returns True on success."""
+def smtp_login(cfg):
+    """Open a new connection to cfg's SMTP server, upgrade it with STARTTLS and log in."""
+    srv = smtplib.SMTP(cfg["host"], cfg["port"])
+    try:
+        srv.starttls()
+        srv.login(cfg["user"], cfg["password"])
+    except Exception:
+        srv.close()
+        raise
+    return srv
+
+
+class SharedSMTP:
+    """
+    One logged-in SMTP connection shared by the entity threads. Sends are serialized on a lock;
+    if the server has dropped the connection it is replaced with a fresh login and the send retried once.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._lock = threading.Lock()
+        self._srv = smtp_login(cfg)
+
+    def send_message(self, msg):
+        with self._lock:
+            try:
+                self._srv.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self._srv = smtp_login(self.cfg)
+                self._srv.send_message(msg)
+
+    def quit(self):
+        with self._lock:
+            try:
+                self._srv.quit()
+            except smtplib.SMTPException:
+                pass
+
+
+def _base64_file(path):
+    """Base64 text (76-char MIME lines) of a file, encoded from an mmap so the raw bytes are never copied into memory."""
+    if os.path.getsize(path) == 0:
+        return ""  # mmap can't map an empty file
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return base64.encodebytes(mm).decode("ascii")
+
+
+def send_report_mail(to_addrs, subject, body_html, attachments=None, cc_addrs=None, smtp_config=None, srv=None):
+    """
+    Send an email with HTML body and optional file attachments. smtp_config: from, host, port, user, password.
+    srv: a connection to reuse across sends (a SharedSMTP, or a logged-in smtplib.SMTP); without it a
+    connection is opened for this message only. Returns True on success.
+    """
     attachments = attachments or []
     cc_addrs = cc_addrs or []
     cfg = smtp_config or {}
@@ -149,15 +222,15 @@ def send_report_mail(to_addrs, subject, body_html, attachments=None, cc_addrs=No
         msg.attach(MIMEText(body_html, "html"))
         for path in attachments:
             if os.path.isfile(path):
-                with open(path, "rb") as f:
-                    part = MIMEBase("application", "octet-stream")
-                    part.set_payload(f.read())
-                    encoders.encode_base64(part)
-                    part.add_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
-                    msg.attach(part)
-        with smtplib.SMTP(cfg["host"], cfg["port"]) as srv:
-            srv.starttls()
-            srv.login(cfg["user"], cfg["password"])
+                part = MIMEBase("application", "octet-stream")
+                part.set_payload(_base64_file(path))
+                part["Content-Transfer-Encoding"] = "base64"
+                part.add_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+                msg.attach(part)
+        if srv is None:
+            with smtp_login(cfg) as own:
+                own.send_message(msg)
+        else:
             srv.send_message(msg)
         return True
     except Exception as e:
@@ -169,12 +242,49 @@ def send_report_mail(to_addrs, subject, body_html, attachments=None, cc_addrs=No
 # 4. PIPELINE — Run reports for all entities (fetch → Excel → email)
 # =============================================================================
 
-def run(demo=False, date_spec=None):
+def _process_entity(entity_id, to_list, cc_map, default_cc, out_dir, smtp, base, host, port, date_spec, srv=None, fmt="xlsx"):
+    """
+    Run Extract → Transform → Load for one entity. Returns (entity_id, out_path, status);
+    out_path is None when no report was written, status is the line to print for the entity.
+    srv is the run's SharedSMTP connection (or None). fmt: xlsx or csv; CSV reports are never emailed.
+    """
+    safe_id = entity_id.replace("@", "-")
+    out_path = os.path.join(out_dir, f"{safe_id}-{date_spec.replace(' -> ', '-')}.{fmt}")
+    try:
+        # Extract: fetch from Drill (the four queries run concurrently)
+        stages, otp, discovery, fi_status = fetch_all(base, entity_id, date_spec, host, port)
+        if stages.empty:
+            return entity_id, None, "No data; skipping."
+
+        # Transform: build funnel table
+        totals = aggregate_stages(stages)
+        table = build_report_table(totals, otp, discovery, fi_status)
+
+        # Load: write Excel (or CSV) and optionally send email
+        write_report(table, out_path, fmt)
+    except Exception as e:
+        return entity_id, None, f"Error: {e}"
+
+    if fmt == "csv":
+        # CSV is for smoke tests / bulk runs; never send unstyled files to recipients.
+        return entity_id, out_path, "Email skipped (CSV output)."
+    subj = f"{entity_id}_user_funnel_{date_spec}"
+    body = f"Dear team,<br>Please find the user funnel for {entity_id} {date_spec}.<br><br>Thanks & Regards,<br>Your Team"
+    cc_list = cc_map.get(entity_id, default_cc)
+    if send_report_mail(to_list, subj, body, [out_path], cc_list, smtp, srv=srv):
+        return entity_id, out_path, "Email sent."
+    return entity_id, out_path, "Email skipped (SMTP not configured)."
+
+
+def run(demo=False, date_spec=None, use_cache=True, fmt="xlsx"):
     """
     Run the ETL pipeline: for each entity, Extract (Drill or mock), Transform (funnel table),
-    Load (Excel + optional email). Uses yesterday if date_spec is None.
+    Load (Excel + optional email). Uses yesterday if date_spec is None. use_cache=False
+    always re-queries Drill instead of reading cached results for past dates. fmt="csv"
+    writes plain CSV reports instead of styled Excel (quicker, e.g. for smoke tests).
     """
     cfg = load_config()
+    configure_cache(cfg["drill_cache_dir"] if use_cache else None)
     to_map, cc_map, default_cc = load_recipients()
     out_dir = cfg["output_dir"]
     smtp = cfg["smtp"]
@@ -197,8 +307,8 @@ def run(demo=False, date_spec=None):
         stages, otp, discovery, fi_status = get_mock_funnel_data()
         totals = aggregate_stages(stages)
         table = build_report_table(totals, otp, discovery, fi_status)
-        out_path = os.path.join(out_dir, f"demo_funnel_report-{date_spec}.xlsx")
-        write_funnel_excel(table, out_path)
+        out_path = os.path.join(out_dir, f"demo_funnel_report-{date_spec}.{fmt}")
+        write_report(table, out_path, fmt)
         print("\nDemo report written:", out_path)
         print("(Email skipped in demo mode.)")
         print("\nDone.")
@@ -208,39 +318,32 @@ def run(demo=False, date_spec=None):
     port = cfg["drill_port"]
     base = cfg["drill_base_path"]
 
-    any_written = False
-    for entity_id, to_list in to_map.items():
-        print("\nEntity:", entity_id)
-        safe_id = entity_id.replace("@", "-")
-        out_path = os.path.join(out_dir, f"{safe_id}-{date_spec.replace(' -> ', '-')}.xlsx")
+    # One SMTP connection (TLS + login once) for the whole batch instead of one per entity.
+    srv = None
+    if fmt != "csv" and smtp.get("user") and smtp.get("password"):
         try:
-            # Extract: fetch from Drill
-            stages = fetch_stage_metrics(base, entity_id, date_spec, host, port)
-            if stages.empty:
-                print("  No data; skipping.")
-                continue
-            otp = fetch_otp_totals(base, entity_id, date_spec, host, port)
-            discovery = fetch_discovery_totals(base, entity_id, date_spec, host, port)
-            fi_status = fetch_fi_status_counts(base, entity_id, date_spec, host, port)
-
-            # Transform: build funnel table
-            totals = aggregate_stages(stages)
-            table = build_report_table(totals, otp, discovery, fi_status)
-
-            # Load: write Excel and optionally send email
-            write_funnel_excel(table, out_path)
-            print("  Written:", out_path)
-            any_written = True
-
-            subj = f"{entity_id}_user_funnel_{date_spec}"
-            body = f"Dear team,<br>Please find the user funnel for {entity_id} {date_spec}.<br><br>Thanks & Regards,<br>Your Team"
-            cc_list = cc_map.get(entity_id, default_cc)
-            if send_report_mail(to_list, subj, body, [out_path], cc_list, smtp):
-                print("  Email sent.")
-            else:
-                print("  Email skipped (SMTP not configured).")
+            srv = SharedSMTP(smtp)
         except Exception as e:
-            print("  Error:", e)
+            logging.error("SMTP login failed: %s", e)
+
+    # Each entity is I/O-bound (Drill HTTP + SMTP), so threads overlap the waits.
+    any_written = False
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(to_map)))) as ex:
+        futures = [
+            ex.submit(_process_entity, entity_id, to_list, cc_map, default_cc, out_dir, smtp, base, host, port, date_spec, srv, fmt)
+            for entity_id, to_list in to_map.items()
+        ]
+        # Print from the main thread only, so each entity's lines stay together.
+        for f in as_completed(futures):
+            entity_id, out_path, status = f.result()
+            print("\nEntity:", entity_id)
+            if out_path:
+                print("  Written:", out_path)
+                any_written = True
+            print(" ", status)
+
+    if srv is not None:
+        srv.quit()
 
     if not any_written:
         print("\nNo reports generated (no data from Drill). Run with --demo to generate a sample report without Drill:")
@@ -253,5 +356,7 @@ if __name__ == "__main__":
     p = argparse.ArgumentParser(description="Funnel Report ETL Pipeline — ETL pipeline for funnel analytics.")
     p.add_argument("--demo", action="store_true", help="Run with mock data; no Drill or .env required. Output: output/demo_funnel_report-<date>.xlsx")
     p.add_argument("--date", type=str, default=None, help="Date for report (dd_mm_yyyy). Default: yesterday.")
+    p.add_argument("--no-cache", action="store_true", help="Always query Drill; ignore cached results in DRILL_CACHE_DIR.")
+    p.add_argument("--format", choices=["xlsx", "csv"], default="xlsx", help="Report file format: styled Excel (default) or plain CSV.")
     args = p.parse_args()
-    run(demo=args.demo, date_spec=args.date)
+    run(demo=args.demo, date_spec=args.date, use_cache=not args.no_cache, fmt=args.format)